@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-Surface Evolver Jupyter Kernel (lazy spawn, manual pexpect; sin REPLWrapper).
+Surface Evolver Jupyter Kernel (lazy spawn, pty propio; sin pexpect).
 
 Motivación
 ----------
@@ -10,42 +10,477 @@ en el búfer y provocando desincronizaciones y relanzamientos repetidos del proc
 Evolver. Para evitarlo, controlamos explícitamente el ciclo
 *spawn → expect(datafile) → send → expect(main prompt) → sendline/expect por comando*.
 
+Tampoco usamos `pexpect.spawn`: su bucle de lectura duerme entre lecturas y vuelve a
+buscar el prompt en todo el búfer acumulado con cada trozo recibido. `EvolverProc`
+es un envoltorio mínimo sobre `os.openpty` + `selectors` que lee sólo lo que llega y
+busca el prompt únicamente en la cola del búfer.
+
 Flujo de arranque
 -----------------
 1. Spawn del binario (ruta de `EVOLVER_CMD`, o `shutil.which('evolver')`, o `'evolver'`).
 2. Espera prompt de datafile (`Enter new datafile name ...:`); tolerante a espacios.
 3. Envía el datafile por defecto (variable `EVOLVER_DATAFILE`; por defecto cadena vacía).
 4. Espera prompt principal `Enter command:` (tolerante a espacios).
-5. Guarda patrón de prompt (`MAIN_PROMPT_PAT` o fallback) y el hijo `pexpect.spawn`.
+5. Guarda patrón de prompt (`_PROMPT_RES['main']` o fallback) y el hijo `EvolverProc`.
 
 Ejecución
 ---------
-- Cada celda se divide en líneas no vacías.
-- Por cada línea: `sendline` → `expect(self._prompt_pat)` → salida = `before`.
-- Si Evolver muere (EOF), se relanza en el siguiente comando.
-- Si `KeyboardInterrupt`, se envía intr al hijo y se intenta recuperar el prompt.
+- Cada celda se divide en líneas no vacías; una celda de una sola línea se
+  ejecuta directamente (`sendline` → `expect(self._prompt_pat)`).
+- Toda la celda se envía de una vez seguida de `print "<marcador único>"`; la celda
+  termina en el primer prompt tras la línea del marcador (sin prompts intermedios).
+- Si alguna línea contiene `?` (posible prompt interactivo de Evolver), se usa el
+  modo línea a línea: `sendline` → `expect(self._prompt_pat)` → salida = `before`.
+- La salida se reenvía al frontend por líneas completas según llega, sin esperar
+  al final de la celda.
+- Si Evolver muere (EOF), se descarta el resto de la celda y se relanza.
+- La espera es asíncrona (`do_execute` es una corrutina): el fd de Evolver se
+  vigila con `loop.add_reader`, sin sondeo, y el kernel sigue atendiendo mensajes.
+- Al interrumpir el kernel (SIGINT) se envía ^C al hijo; Evolver vuelve al prompt
+  y se descarta el resto de la celda.
 
 Variables de entorno
 --------------------
 EVOLVER_CMD            Ruta al binario Evolver (default: `which evolver` o `evolver`).
 EVOLVER_DATAFILE       Datafile inicial; cadena vacía => continuar sin cargar.
 EVOLVER_KERNEL_DEBUG   Si está definida (cualquier valor), vuelca E/S cruda de Evolver en stderr.
+EVOLVER_KERNEL_SUPERVISOR
+                       Si está definida, no se lanza Evolver por kernel: se usa un
+                       Evolver persistente (uno por binario + datafile) servido por
+                       `evolver_kernel.supervisor` a través de un socket Unix, que
+                       sobrevive a los reinicios del kernel.
 
 """
 
 from ipykernel.kernelbase import Kernel
+import asyncio
+import contextlib
+import errno
+import fcntl
+import functools
 import os
+import re
+import selectors
 import shutil
 import signal
 import sys
-import pexpect
-from pexpect import EOF as PexpectEOF, TIMEOUT as PexpectTIMEOUT
+import termios
+import time
+import uuid
 
 # ---------------------------------------------------------------------------
-# Patrones de prompt (regex tolerantes)
+# Patrones de prompt (regex tolerantes, compiladas una sola vez)
+#
+# Van anclados al final del búfer (``\Z``): el prompt es lo último que escribe
+# Evolver antes de esperar entrada, así que basta mirar la cola de lo leído.
+# ``[ \t]*`` (y no ``\s*``) evita que un salto de línea forme parte del prompt.
+# Son patrones de bytes: se buscan sobre la salida cruda, sin decodificarla.
 # ---------------------------------------------------------------------------
-FILE_PROMPT_PAT = r'Enter new datafile name\s*\(none to continue, q to quit\):\s*'
-MAIN_PROMPT_PAT = r'Enter command:\s*'
+_PROMPTS = {
+    'file': rb'Enter new datafile name\s*\(none to continue, q to quit\):[ \t]*',
+    'main': rb'Enter command:[ \t]*',
+    'fallback': rb'> ',
+}
+_PROMPT_RES = {kind: re.compile(pat + rb'\Z') for kind, pat in _PROMPTS.items()}
+
+# Los mismos prompts en medio de la salida (prompts intermedios de una celda
+# enviada en bloque); empiezan línea, varios seguidos si un comando no imprime nada.
+_PROMPT_INLINE_RES = {kind: re.compile(rb'^(?:' + pat + rb')+', re.M)
+                      for kind, pat in _PROMPTS.items()}
+
+# Línea de marcador de fin de celda (``_run_batch``). Se eliminan todas, no sólo
+# la propia: tras una interrupción tardía puede llegar la de una celda anterior.
+_MARKER_PREFIX = b'__EVOLVER_CELL_'
+_MARKER_LINE_RE = re.compile(re.escape(_MARKER_PREFIX) + rb'([0-9a-f]{32})__\r?\n')
+
+# Lectura del pty: hasta MAXREAD bytes por llamada a ``os.read`` (menos
+# llamadas al sistema con salidas grandes). El prompt anclado se busca sólo en
+# los últimos SEARCH_WINDOW bytes del búfer: el prompt más largo ronda los 55
+# caracteres y el resto es holgura; así cada trozo leído cuesta O(prompt).
+MAXREAD = 65536
+SEARCH_WINDOW = 256
+
+# Agrupación de la salida en mensajes iopub `stream`: se envía al reunir
+# STREAM_CHUNK caracteres o cuando lo pendiente tiene más de STREAM_DELAY s.
+STREAM_CHUNK = 16384
+STREAM_DELAY = 0.02
+
+
+@functools.lru_cache(maxsize=1)
+def _resolve_evolver():
+    """Ruta de ``evolver`` en el PATH; se busca una sola vez por proceso."""
+    return shutil.which('evolver') or 'evolver'
+
+
+# ---------------------------------------------------------------------------
+# Proceso Evolver sobre un pty propio
+# ---------------------------------------------------------------------------
+class EvolverProcError(Exception):
+    """Error base de la comunicación con el proceso Evolver."""
+
+
+class EvolverEOF(EvolverProcError):
+    """Evolver cerró su terminal (terminó o murió)."""
+
+
+class EvolverTimeout(EvolverProcError):
+    """No apareció el patrón esperado dentro del plazo."""
+
+
+# Errores de escritura que significan que el otro extremo ya no existe; el resto
+# (``BlockingIOError`` incluido) no es un EOF.
+_EOF_ERRNOS = frozenset((errno.EIO, errno.EBADF, errno.EPIPE, errno.ECONNRESET))
+
+
+def _write_error(exc):
+    """``EvolverEOF`` si ``exc`` indica que el otro extremo se cerró; si no, ``exc``."""
+    if exc.errno in _EOF_ERRNOS:
+        return EvolverEOF(str(exc))
+    return exc
+
+
+class EvolverProc:
+    """Hijo Evolver en un pty (``os.openpty`` + ``fork``) con lectura no bloqueante.
+
+    Imita la parte de ``pexpect.spawn`` que usa el kernel (``send``, ``sendline``,
+    ``sendintr``, ``expect``, ``before``/``before_bytes``, ``isalive``, ``close``),
+    pero espera sin dormir, lee sólo lo recién llegado y busca el patrón sólo en
+    la cola del búfer. El kernel espera con ``expect_async`` en su bucle de
+    eventos; el ``expect`` síncrono (con ``selectors``) queda para el supervisor.
+    La entrada pendiente se escribe intercalada con la lectura, de modo que una
+    celda grande no se bloquea contra la salida de Evolver.
+    """
+
+    def __init__(self, cmd, args=(), timeout=30, maxread=MAXREAD,
+                 searchwindowsize=SEARCH_WINDOW, logfile=None):
+        # ``openpty`` + ``fork`` en vez de ``forkpty``: el padre guarda la ruta
+        # del esclavo para vaciar su cola de entrada al interrumpir (``sendintr``)
+        fd, slave = os.openpty()
+        self._tty = os.ttyname(slave)
+        pid = os.fork()
+        if pid == 0:  # hijo
+            try:
+                os.close(fd)
+                os.setsid()
+                fcntl.ioctl(slave, termios.TIOCSCTTY, 0)
+                for std in (0, 1, 2):
+                    os.dup2(slave, std)
+                os.close(slave)
+                # El kernel puede tener SIGINT ignorada, y SIG_IGN sobrevive a
+                # exec: Evolver debe recibir el ^C con la acción por defecto.
+                # Sólo en el hijo, sin tocar el manejador del kernel.
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                # Sin eco. ICANON sólo afecta a la entrada: la salida (prompts
+                # sin '\n' incluidos) llega al kernel en cuanto Evolver la
+                # escribe. Se mantiene a propósito: con entrada por líneas,
+                # Evolver lee una línea por read() y el resto de una celda en
+                # bloque sigue en la cola del pty, que ``sendintr`` vacía.
+                attrs = termios.tcgetattr(0)
+                attrs[3] &= ~termios.ECHO
+                termios.tcsetattr(0, termios.TCSANOW, attrs)
+                os.execvp(cmd, [cmd, *args])
+            except BaseException as exc:  # noqa: BLE001
+                os.write(2, f"[EvolverKernel] no pude ejecutar {cmd!r}: {exc}\n".encode())
+            finally:
+                os._exit(127)
+        os.close(slave)
+        self.pid = pid
+        self.exitstatus = None
+        self._attach(fd, timeout, maxread, searchwindowsize, logfile)
+
+    def _attach(self, fd, timeout, maxread, searchwindowsize, logfile):
+        """Prepara la E/S no bloqueante sobre ``fd`` (pty o socket)."""
+        os.set_blocking(fd, False)
+        self.fd = fd
+        self.timeout = timeout
+        self.maxread = maxread
+        self.searchwindowsize = searchwindowsize
+        self.logfile = logfile  # None => sin volcado de E/S
+        self.before_bytes = b''
+        self._buf = bytearray()
+        self._pending = bytearray()
+        self._sel = selectors.DefaultSelector()
+        self._events = selectors.EVENT_READ
+        self._sel.register(fd, self._events)
+
+    # -- escritura ------------------------------------------------------
+    def send(self, s):
+        if self.logfile is not None:
+            self.logfile.write(s)
+            self.logfile.flush()
+        self.write(s.encode('utf-8'))
+
+    def write(self, data):
+        """Encola bytes crudos hacia Evolver y escribe lo que se pueda ya."""
+        self._pending += data
+        self._flush_pending()
+
+    def sendline(self, s=''):
+        self.send(s + '\n')
+
+    def sendintr(self):
+        """Interrumpe a Evolver fuera de banda.
+
+        Descarta la entrada aún no enviada y la que espera en la cola del pty, y
+        envía SIGINT al grupo en primer plano del terminal. Escribir ``^C`` en el
+        maestro no basta: con la cola llena (celda grande) no cabe, y lo encolado
+        seguiría ejecutándose.
+        """
+        self._pending.clear()
+        try:
+            slave = os.open(self._tty, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+            try:
+                termios.tcflush(slave, termios.TCIFLUSH)
+            finally:
+                os.close(slave)
+            os.killpg(os.tcgetpgrp(self.fd), signal.SIGINT)
+            return
+        except ProcessLookupError as exc:
+            raise EvolverEOF(str(exc)) from exc
+        except OSError:
+            pass  # el maestro no informa del grupo: ^C por la disciplina de línea
+        try:
+            os.write(self.fd, b'\x03')
+        except OSError as exc:
+            raise _write_error(exc) from exc
+
+    def _flush_pending(self):
+        try:
+            n = os.write(self.fd, self._pending)
+        except BlockingIOError:
+            return
+        except OSError as exc:
+            raise _write_error(exc) from exc
+        del self._pending[:n]
+
+    # -- lectura --------------------------------------------------------
+    def _read(self, wait):
+        """Espera hasta ``wait`` s escribiendo la entrada pendiente.
+
+        Devuelve los bytes leídos, ``None`` si no llegó nada o ``b''`` en EOF.
+        """
+        events = selectors.EVENT_READ
+        if self._pending:
+            events |= selectors.EVENT_WRITE
+        if events != self._events:
+            self._sel.modify(self.fd, events)
+            self._events = events
+        for _key, mask in self._sel.select(wait):
+            if mask & selectors.EVENT_WRITE:
+                self._flush_pending()
+            if mask & selectors.EVENT_READ:
+                try:
+                    return os.read(self.fd, self.maxread)
+                except BlockingIOError:
+                    return None
+                except OSError:  # EIO: el hijo cerró el pty
+                    return b''
+        return None
+
+    def _feed(self, chunk, log, on_output):
+        """Añade ``chunk`` al búfer; con ``on_output`` le entrega y descarta las
+        líneas completas."""
+        if log is not None:
+            log.write(chunk.decode('utf-8', 'replace'))
+            log.flush()
+        buf = self._buf
+        buf += chunk
+        if on_output is not None:
+            cut = buf.rfind(b'\n') + 1
+            if cut:
+                on_output(bytes(buf[:cut]))
+                del buf[:cut]
+
+    def _match(self, pattern, window):
+        """Busca ``pattern`` en la cola del búfer; si aparece, fija ``before_bytes``
+        y consume hasta el final de la coincidencia."""
+        buf = self._buf
+        m = pattern.search(buf, max(0, len(buf) - window))
+        if m is None:
+            return False
+        self.before_bytes = bytes(buf[:m.start()])
+        del buf[:m.end()]
+        return True
+
+    def _eof(self):
+        self.before_bytes = bytes(self._buf)
+        self._buf.clear()
+        return EvolverEOF("Evolver cerró el terminal")
+
+    def expect(self, pattern, timeout=-1, window=None):
+        """Lee hasta que ``pattern`` (regex de bytes compilada) aparece en la salida.
+
+        ``pattern`` debe ir anclado al final (``\\Z``): sólo se busca en los
+        últimos ``window`` bytes del búfer (por defecto ``searchwindowsize``).
+        Deja en ``before_bytes`` la salida anterior a la coincidencia y la
+        descarta del búfer. ``timeout=None`` espera indefinidamente. Aquí no se
+        decodifica nada.
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        if window is None:
+            window = self.searchwindowsize
+        deadline = None if timeout is None else time.monotonic() + timeout
+        log = self.logfile
+        while not self._match(pattern, window):
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    self.before_bytes = bytes(self._buf)
+                    raise EvolverTimeout(f"timeout esperando {pattern.pattern!r}")
+            chunk = self._read(wait)
+            if chunk is None:
+                continue
+            if not chunk:
+                raise self._eof()
+            self._feed(chunk, log, None)
+        return 0
+
+    async def expect_async(self, pattern, timeout=-1, window=None,
+                           on_output=None, idle=None):
+        """Como ``expect``, pero sin bloquear: espera en el bucle de eventos.
+
+        La lectura la dispara ``loop.add_reader`` en cuanto hay datos en el fd
+        (sin sondeo ni esperas fijas), y la entrada pendiente se escribe con
+        ``loop.add_writer``; mientras tanto el kernel sigue atendiendo otros
+        mensajes.
+
+        Si se da ``on_output``, las líneas completas (bytes) se le entregan según
+        llegan y salen del búfer (``pattern`` no debe abarcar saltos de línea);
+        ``before_bytes`` contiene entonces sólo la última línea, sin terminar.
+        Con ``idle`` (s), ``on_output(b'')`` se llama además tras cada ``idle`` s
+        sin datos, para que el consumidor pueda vaciar lo que tenga retenido.
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        if window is None:
+            window = self.searchwindowsize
+        if self._match(pattern, window):
+            return 0
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        log = self.logfile
+        fd = self.fd
+
+        def finish(exc=None):
+            if not done.done():
+                if exc is None:
+                    done.set_result(0)
+                else:
+                    done.set_exception(exc)
+
+        def on_readable():
+            if done.done():
+                return
+            try:
+                chunk = os.read(fd, self.maxread)
+            except BlockingIOError:
+                return
+            except OSError:  # EIO: el hijo cerró el pty
+                chunk = b''
+            if not chunk:
+                finish(self._eof())
+                return
+            try:
+                self._feed(chunk, log, on_output)
+            except Exception as exc:  # noqa: BLE001
+                finish(exc)
+                return
+            if self._match(pattern, window):
+                finish()
+
+        def on_writable():
+            try:
+                self._flush_pending()
+            except EvolverEOF as exc:
+                finish(exc)
+            if not self._pending:
+                loop.remove_writer(fd)
+
+        def on_idle():
+            nonlocal ticker
+            on_output(b'')
+            ticker = loop.call_later(idle, on_idle)
+
+        ticker = None if idle is None else loop.call_later(idle, on_idle)
+        loop.add_reader(fd, on_readable)
+        if self._pending:
+            loop.add_writer(fd, on_writable)
+        try:
+            return await asyncio.wait_for(done, timeout)
+        except asyncio.TimeoutError:
+            self.before_bytes = bytes(self._buf)
+            raise EvolverTimeout(f"timeout esperando {pattern.pattern!r}") from None
+        finally:
+            loop.remove_reader(fd)
+            loop.remove_writer(fd)
+            if ticker is not None:
+                ticker.cancel()
+
+    @property
+    def before(self):
+        """``before_bytes`` decodificado (UTF-8)."""
+        return self.before_bytes.decode('utf-8', 'replace')
+
+    # -- ciclo de vida --------------------------------------------------
+    def isalive(self):
+        if self.exitstatus is not None:
+            return False
+        pid, status = os.waitpid(self.pid, os.WNOHANG)
+        if pid == 0:
+            return True
+        self.exitstatus = status
+        return False
+
+    def close(self):
+        if self.fd < 0:
+            return
+        self._sel.close()
+        os.close(self.fd)
+        self.fd = -1
+        for sig in (signal.SIGHUP, signal.SIGKILL):
+            if not self.isalive():
+                break
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                break
+            time.sleep(0.1)
+        if self.exitstatus is None:
+            _pid, self.exitstatus = os.waitpid(self.pid, 0)
+
+
+class _StreamBuffer:
+    """Agrupa la salida cruda antes de enviarla como un único mensaje iopub.
+
+    ``append`` acumula bytes en un ``bytearray``; se decodifica una sola vez y se
+    envía todo junto (vía ``send``) al llegar a ``STREAM_CHUNK`` bytes o si lo
+    pendiente tiene más de ``STREAM_DELAY`` s. ``flush`` envía lo que quede al
+    final de la celda. Los trozos recibidos terminan siempre en un límite de
+    carácter (fin de línea o inicio de prompt), así que la decodificación por
+    tandas no parte caracteres UTF-8.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._buf = bytearray()
+        self._since = 0.0
+
+    def append(self, data):
+        if data:
+            if not self._buf:
+                self._since = time.monotonic()
+            self._buf += data
+        if self._buf and (len(self._buf) >= STREAM_CHUNK
+                          or time.monotonic() - self._since > STREAM_DELAY):
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            text = self._buf.decode('utf-8', 'replace')
+            self._buf.clear()
+            self._send(text)
 
 
 class EvolverKernel(Kernel):
@@ -64,63 +499,77 @@ class EvolverKernel(Kernel):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         # Configuración (lazy spawn: Evolver se lanza en la primera ejecución real)
-        self._evolver_cmd = os.environ.get('EVOLVER_CMD', shutil.which('evolver') or 'evolver')
+        self._evolver_cmd = os.environ.get('EVOLVER_CMD') or _resolve_evolver()
         self._default_datafile = os.environ.get('EVOLVER_DATAFILE', '')
         self._debug = bool(os.environ.get('EVOLVER_KERNEL_DEBUG'))
-        self.child = None            # pexpect.spawn instance
-        self._prompt_pat = MAIN_PROMPT_PAT  # regex del prompt principal
+        self._supervised = bool(os.environ.get('EVOLVER_KERNEL_SUPERVISOR'))
+        self.child = None            # instancia EvolverProc
+        self._use_prompt('main')
+        self._interrupted = False    # se pidió interrumpir la celda en curso
+        self._starting = None        # tarea de arranque de Evolver en curso
+        self._handshake_announced = False  # el aviso de arranque ya se mostró
 
     # ------------------------------------------------------------------
     # Arranque + handshake
     # ------------------------------------------------------------------
-    def _spawn_and_handshake(self, timeout=30):
+    async def _spawn_and_handshake(self, timeout=30):
         """Lanza Surface Evolver y realiza handshake.
 
-        Retorna el objeto ``pexpect.spawn`` listo en el prompt principal.
+        Retorna el objeto ``EvolverProc`` listo en el prompt principal.
         Lanza excepción ante fallo grave; el caller la captura.
         """
-        sig = signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # Con depuración, E/S cruda de Evolver al stderr del servidor Jupyter;
+        # sin ella, logfile=None y el bucle de lectura no hace nada más
+        child = EvolverProc(self._evolver_cmd, timeout=timeout,
+                            logfile=sys.__stderr__ if self._debug else None)
+        # Ante cualquier fallo (también ^C) el hijo se cierra y se recoge: sin
+        # zombis ni fds del pty abiertos por cada intento fallido
         try:
-            child = pexpect.spawn(
-                self._evolver_cmd,
-                echo=False,
-                encoding='utf-8',
-                codec_errors='replace',
-                timeout=timeout,
-            )
-
-            if self._debug:
-                # Ver E/S cruda de Evolver en el stderr del servidor Jupyter
-                child.logfile = sys.__stderr__
-
-            # 1) Prompt de datafile (tolerante)
-            try:
-                child.expect(FILE_PROMPT_PAT, timeout=timeout)
-            except PexpectTIMEOUT:
-                self._emit_stderr("[EvolverKernel] No vi prompt de datafile; continúo.\n")
-            # responder datafile (vacío => continuar sin cargar)
-            child.sendline(self._default_datafile)
+            await self._handshake(child, timeout)
+        except EvolverEOF as exc:
+            child.close()
+            # El motivo real (p. ej. un ``exec`` fallido) quedó escrito en el pty
+            detail = child.before.strip()
+            raise EvolverEOF(f"{exc}: {detail}" if detail else str(exc)) from None
+        except BaseException:
+            child.close()
+            raise
+        return child
 
-            # 2) Prompt principal
-            try:
-                child.expect(MAIN_PROMPT_PAT, timeout=timeout)
-            except PexpectTIMEOUT:
-                # Nudge
-                child.sendline('')
-                try:
-                    child.expect(MAIN_PROMPT_PAT, timeout=5)
-                except PexpectTIMEOUT:
-                    self._emit_stderr("[EvolverKernel] No vi prompt principal; uso fallback '> '.\n")
-                    self._prompt_pat = r'> '
-                    self._emit_stdout("[EvolverKernel] Evolver lanzado con prompt fallback.\n")
-                    return child
-            # Si llegamos aquí, vimos prompt principal
-            self._prompt_pat = MAIN_PROMPT_PAT
-            self._emit_stdout("[EvolverKernel] Evolver lanzado. Prompt principal listo.\n")
-            return child
+    async def _handshake(self, child, timeout):
+        # Esperas asíncronas: el arranque (hasta 2 x ``timeout``) no bloquea el
+        # bucle de eventos del kernel
+        # 1) Prompt de datafile (tolerante)
+        try:
+            await child.expect_async(_PROMPT_RES['file'], timeout=timeout)
+        except EvolverTimeout:
+            self._emit_stderr("[EvolverKernel] No vi prompt de datafile; continúo.\n")
+        # responder datafile (vacío => continuar sin cargar)
+        child.sendline(self._default_datafile)
 
-        finally:
-            signal.signal(signal.SIGINT, sig)
+        # 2) Prompt principal
+        try:
+            await child.expect_async(_PROMPT_RES['main'], timeout=timeout)
+        except EvolverTimeout:
+            self._emit_stderr("[EvolverKernel] No vi prompt principal; uso fallback '> '.\n")
+            self._use_prompt('fallback')
+            self._announce("[EvolverKernel] Evolver lanzado con prompt fallback.\n")
+            return
+        # Si llegamos aquí, vimos prompt principal
+        self._use_prompt('main')
+        self._announce("[EvolverKernel] Evolver lanzado. Prompt principal listo.\n")
+
+    def _announce(self, text):
+        """Aviso de arranque, sólo la primera vez: un reinicio tras EOF (ya
+        avisado por stderr) no lo intercala en la salida de la celda."""
+        if not self._handshake_announced:
+            self._handshake_announced = True
+            self._emit_stdout(text)
+
+    def _use_prompt(self, kind):
+        """Fija el prompt (``'main'`` o ``'fallback'``) que cierra cada comando."""
+        self._prompt_pat = _PROMPT_RES[kind]           # prompt al final del búfer
+        self._prompt_strip = _PROMPT_INLINE_RES[kind]  # prompts intermedios a eliminar
 
     # ------------------------------------------------------------------
     # Estado del hijo Evolver
@@ -131,37 +580,147 @@ class EvolverKernel(Kernel):
     # ------------------------------------------------------------------
     # Asegurar proceso Evolver
     # ------------------------------------------------------------------
-    def _ensure_evolver(self):
+    async def _ensure_evolver(self):
+        """Lanza Evolver (o conecta con el supervisor) si no está vivo.
+
+        El arranque corre en una tarea propia: una interrupción del kernel la
+        cancela (``_interrupt_evolver``), el hijo se cierra y la celda termina.
+        """
         if self._alive():
             return
+        if self.child is not None:
+            self.child.close()
+            self.child = None
+        starting = self._starting = asyncio.ensure_future(self._start_evolver())
         try:
-            self.child = self._spawn_and_handshake(timeout=30)
+            await asyncio.wait({starting})
+        finally:
+            self._starting = None
+            starting.cancel()  # sin efecto si ya terminó; si no, no sobrevive a la celda
+        if starting.cancelled():
+            self._emit_stderr("[EvolverKernel] Arranque de Evolver interrumpido.\n")
+
+    async def _start_evolver(self):
+        try:
+            if self._supervised:
+                await self._attach_supervisor(timeout=30)
+            else:
+                self.child = await self._spawn_and_handshake(timeout=30)
+        except asyncio.CancelledError:
+            self._drop_child()
+            raise
         except Exception as exc:  # noqa: BLE001
-            self.child = None
+            self._drop_child()
             self._emit_stderr(f"[EvolverKernel] ERROR lanzando Evolver: {exc}\n")
 
+    def _drop_child(self):
+        if self.child is not None:
+            self.child.close()
+        self.child = None
+
+    async def _attach_supervisor(self, timeout=30):
+        """Conecta con el Evolver persistente del supervisor y se resincroniza.
+
+        El supervisor ya hizo el handshake del datafile; la conexión puede traer
+        salida pendiente de un kernel anterior, así que se envía un marcador
+        (``_run_batch`` vacío) y se descarta todo hasta él.
+        """
+        from . import supervisor
+
+        self.child = await supervisor.connect(
+            self._evolver_cmd, self._default_datafile, timeout=timeout,
+            logfile=sys.__stderr__ if self._debug else None)
+        self._use_prompt('main')
+        await self._resync(self._prompt_pat, self._discard, timeout=timeout)
+        self._announce("[EvolverKernel] Conectado al Evolver persistente.\n")
+
     # ------------------------------------------------------------------
     # Enviar una línea y capturar salida
     # ------------------------------------------------------------------
-    def _run_line(self, line, timeout=None):
-        """Envía una línea a Evolver y devuelve la salida (texto antes del prompt)."""
-        if timeout is None:
-            timeout = None  # bloqueo hasta que aparezca prompt
-        self.child.sendline(line)
-        self.child.expect(self._prompt_pat, timeout=timeout)
-        return self.child.before
+    # ``pat`` es el prompt de la sesión (``self._prompt_pat``), que ``do_execute``
+    # lee una sola vez por celda y pasa a cada variante.
+    async def _run_line(self, line, pat, on_output, timeout=None):
+        """Envía una línea a Evolver y entrega su salida (bytes antes del prompt
+        ``pat``) a ``on_output`` a medida que llega. ``timeout=None`` espera
+        hasta que aparezca el prompt."""
+        child = self.child
+        child.sendline(line)
+        await child.expect_async(pat, timeout=timeout, on_output=on_output,
+                                 idle=STREAM_DELAY)
+        if child.before_bytes:
+            on_output(child.before_bytes)
+
+    async def _run_lines(self, lines, pat, on_output, timeout=None):
+        """Como ``_run_line`` para cada línea, con una ida y vuelta por línea.
+
+        Los métodos del hijo se enlazan una vez a nombres locales.
+        """
+        child = self.child
+        send = child.sendline
+        expect = child.expect_async
+        for ln in lines:
+            if self._interrupted:
+                break
+            send(ln)
+            await expect(pat, timeout=timeout, on_output=on_output, idle=STREAM_DELAY)
+            if child.before_bytes:
+                on_output(child.before_bytes)
+
+    async def _run_batch(self, source, pat, on_output, timeout=None):
+        """Envía varias líneas en un único envío y entrega su salida conjunta
+        a ``on_output`` a medida que llega.
+
+        Tras el código se pide a Evolver que imprima un marcador único; la celda
+        termina en el primer prompt posterior a la línea del marcador. Se eliminan
+        de la salida los prompts intermedios de cada comando y el marcador.
+        Tras una interrupción (``sendintr`` descarta la entrada aún no leída,
+        marcador incluido) termina en el primer prompt; ``do_execute`` se
+        resincroniza después con ``_resync``.
+        """
+        token = uuid.uuid4().hex.encode()
+        done = False
+
+        def emit(data):
+            nonlocal done
+            if not data:  # tick de ``idle``: nada que limpiar, sólo reenviarlo
+                on_output(data)
+                return
+            data = self._prompt_strip.sub(b'', data)
+            if _MARKER_PREFIX in data:
+                for m in _MARKER_LINE_RE.finditer(data):
+                    done = done or m.group(1) == token
+                data = _MARKER_LINE_RE.sub(b'', data)
+            on_output(data)
+
+        child = self.child
+        child.send(f'{source}\nprint "{_MARKER_PREFIX.decode()}{token.decode()}__"\n')
+        while not (done or self._interrupted):
+            await child.expect_async(pat, timeout=timeout, on_output=emit,
+                                     idle=STREAM_DELAY)
+            emit(child.before_bytes)
+
+    async def _resync(self, pat, on_output, timeout=None):
+        """Envía un marcador nuevo y espera a verlo impreso.
+
+        Al volver, Evolver ya procesó toda la entrada anterior (la de otro
+        kernel o la que sobrevivió a una interrupción); lo que imprima hasta
+        entonces va a ``on_output``.
+        """
+        await self._run_batch('', pat, on_output, timeout=timeout)
 
     # ------------------------------------------------------------------
     # API Jupyter: ejecutar código de una celda
     # ------------------------------------------------------------------
-    def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False):
+    async def do_execute(self, code, silent, store_history=True, user_expressions=None,
+                         allow_stdin=False):
         code = code.rstrip('\n')
         if not code.strip():
             return {'status': 'ok', 'execution_count': self.execution_count,
                     'payload': [], 'user_expressions': {}}
 
         # Lazy spawn
-        self._ensure_evolver()
+        with self._forward_sigint():
+            await self._ensure_evolver()
 
         if not self._alive():
             msg = "[EvolverKernel] ERROR: no pude lanzar Surface Evolver.\n"
@@ -170,42 +729,106 @@ class EvolverKernel(Kernel):
             return {'status': 'error', 'execution_count': self.execution_count,
                     'ename': 'RuntimeError', 'evalue': msg, 'traceback': []}
 
-        outputs = []
+        # isspace() no crea una cadena nueva por línea, a diferencia de strip()
+        lines = [l for l in code.splitlines() if l and not l.isspace()]
+        if len(lines) == 1:
+            # Caso más común (`g`, `r`, `V`...): un sendline + un expect, sin marcador
+            run, src = self._run_line, lines[0]
+        elif any('?' in l for l in lines):
+            # Posibles prompts interactivos: una ida y vuelta por línea
+            run, src = self._run_lines, lines
+        else:
+            run, src = self._run_batch, '\n'.join(lines)
 
-        
-        for ln in (l for l in code.splitlines() if l.strip()):
-            try:
-                out = self._run_line(ln, timeout=None)
-            except KeyboardInterrupt:
-                self.child.sendintr()
+        # La salida (bytes) se envía al frontend según llega, agrupada en
+        # mensajes de tamaño moderado y decodificada una vez por mensaje
+        stream = _StreamBuffer(self._discard if silent else self._emit_stdout)
+        on_output = stream.append
+        child = self.child
+        pat = self._prompt_pat
+        self._interrupted = False
+        try:
+            with self._forward_sigint():
                 try:
-                    self.child.expect(self._prompt_pat, timeout=2)
-                except Exception:  # pragma: no cover
-                    pass
-                out = self.child.before
-            except PexpectEOF:
-                self._emit_stderr("[EvolverKernel] Evolver murió (EOF); reinicio.\n")
-                self.child = None
-                self._ensure_evolver()
-                out = ""
-            except Exception as e:  # noqa: BLE001
-                out = f"[EvolverKernel] Excepción ejecutando '{ln}': {e}\n"
-            outputs.append(out)
-
-        text = "".join(outputs)
-        if not silent and text:
-            self._emit_stdout(text)
+                    await run(src, pat, on_output, timeout=None)
+                except KeyboardInterrupt:
+                    # Sólo si no se pudo reenviar SIGINT desde el bucle de eventos
+                    self._interrupt_evolver()
+                # Tras una interrupción no se da por vacía la entrada pendiente:
+                # se espera a un marcador nuevo (otra interrupción lo repite)
+                while self._interrupted:
+                    self._interrupted = False
+                    await self._resync(pat, on_output)
+        except EvolverEOF:
+            stream.flush()
+            self._emit_stderr("[EvolverKernel] Evolver murió (EOF); reinicio.\n")
+            child.close()
+            self.child = None
+            with self._forward_sigint():
+                await self._ensure_evolver()
+        except EvolverProcError as e:
+            on_output(f"[EvolverKernel] Excepción ejecutando la celda: {e}\n".encode())
+        stream.flush()
 
         return {'status': 'ok', 'execution_count': self.execution_count,
                 'payload': [], 'user_expressions': {}}
 
+    # ------------------------------------------------------------------
+    # Interrupción
+    # ------------------------------------------------------------------
+    @contextlib.contextmanager
+    def _forward_sigint(self):
+        """Mientras se espera a Evolver, SIGINT (interrumpir kernel) se atiende
+        con ``loop.add_signal_handler``, en vez de lanzar ``KeyboardInterrupt``
+        dentro del bucle de eventos. Durante una celda se reenvía como ^C al
+        hijo: Evolver aborta el comando y vuelve al prompt, lo que cierra la
+        celda con normalidad. Durante el arranque lo cancela."""
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, self._interrupt_evolver)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Bucle fuera del hilo principal: queda el KeyboardInterrupt clásico
+            yield
+            return
+        try:
+            yield
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+
+    def _interrupt_evolver(self):
+        if self._starting is not None:
+            self._starting.cancel()  # arranque a medias: se cierra el hijo
+            return
+        self._interrupted = True
+        if self._alive():
+            try:
+                self.child.sendintr()
+            except EvolverProcError:
+                pass  # hijo muerto o inalcanzable: ``_resync`` lo verá como EOF
+
+    # ------------------------------------------------------------------
+    # API Jupyter: apagado
+    # ------------------------------------------------------------------
+    def do_shutdown(self, restart):
+        if self.child is not None:
+            self.child.close()
+            self.child = None
+        return {'status': 'ok', 'restart': restart}
+
     # ------------------------------------------------------------------
     # Output helpers
     # ------------------------------------------------------------------
     def _emit_stdout(self, text):
+        if not text:  # comandos sin salida (``set ...``): ningún mensaje iopub
+            return
         self.send_response(self.iopub_socket, 'stream',
                            {'name': 'stdout', 'text': text})
 
+    def _discard(self, text):
+        pass
+
     def _emit_stderr(self, text):
+        if not text:
+            return
         self.send_response(self.iopub_socket, 'stream',
                            {'name': 'stderr', 'text': text})
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+Supervisor de un Evolver persistente, compartido entre reinicios del kernel.
+
+Lanzar Surface Evolver y hacer el handshake del datafile cuesta cientos de ms por
+kernel. Con `EVOLVER_KERNEL_SUPERVISOR` definida, el kernel no lanza Evolver: se
+conecta por un socket Unix a un proceso supervisor independiente que mantiene el
+Evolver vivo y reenvía bytes entre el socket y su pty.
+
+- Hay un supervisor por (binario, datafile, directorio de trabajo): Evolver
+  corre en el directorio del kernel, donde se resuelven el datafile y las rutas
+  relativas de `load`/`dump`, así que notebooks de directorios distintos no
+  comparten Evolver. El socket `<hash>.sock` vive en un
+  directorio propio del usuario con permisos 0700 (`evolver-kernel-<uid>` bajo
+  `XDG_RUNTIME_DIR` o, si no existe, el directorio temporal) y se crea con 0600.
+  Ambos extremos comprueban que el otro proceso es del mismo usuario: el código
+  de las celdas (que puede incluir `system`) no se envía a nadie más.
+- El primer kernel que no encuentra el socket lanza el supervisor
+  (`python -m evolver_kernel.supervisor`), que se separa en una sesión propia y
+  sobrevive al kernel.
+- Sólo hay un cliente a la vez. Al conectar, el supervisor responde con un byte:
+  `_ACCEPTED`, o `_BUSY` si otro kernel ya lo usa (y cierra la conexión); así
+  ningún kernel desplaza a otro ni pierde celdas. Sin cliente, la salida de
+  Evolver se descarta.
+- El supervisor termina cuando Evolver muere o tras `IDLE_TIMEOUT` s sin cliente.
+
+"""
+
+import asyncio
+import hashlib
+import os
+import selectors
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+
+from .kernel import (EvolverEOF, EvolverProc, EvolverProcError, EvolverTimeout,
+                     MAXREAD, SEARCH_WINDOW, _PROMPT_RES, _write_error)
+
+# Segundos sin ningún kernel conectado tras los que el supervisor termina
+IDLE_TIMEOUT = 600
+
+# Respuesta del supervisor a cada conexión nueva (primer byte recibido)
+_ACCEPTED = b'+'
+_BUSY = b'-'
+
+# Aviso por el pipe de arranque (``_launch``) de que el supervisor ya escucha
+_READY = b'ready\n'
+
+
+class SupervisorBusy(EvolverProcError):
+    """Otro kernel está conectado al mismo Evolver persistente."""
+
+
+def _socket_dir():
+    """Directorio privado (0700) de los sockets; se crea si hace falta.
+
+    Si ya existe, debe ser un directorio real del usuario sin permisos para
+    nadie más: otro usuario podría haberlo creado antes para suplantar al
+    supervisor.
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    path = os.path.join(base, f"evolver-kernel-{os.getuid()}")
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+            or st.st_mode & 0o077):
+        raise PermissionError(f"directorio de sockets inseguro: {path}")
+    return path
+
+
+def socket_path(cmd, datafile, cwd):
+    """Ruta del socket del supervisor para ``cmd`` + ``datafile`` en ``cwd``."""
+    digest = hashlib.sha1(f"{cmd}\0{datafile}\0{cwd}".encode()).hexdigest()[:12]
+    return os.path.join(_socket_dir(), f"{digest}.sock")
+
+
+def _peer_uid(sock):
+    """uid del proceso al otro lado de ``sock`` (``SO_PEERCRED``); ``None`` si
+    el sistema no lo ofrece."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    _pid, uid, _gid = struct.unpack('3i', creds)
+    return uid
+
+
+class SupervisedEvolver(EvolverProc):
+    """``EvolverProc`` sobre la conexión con el supervisor en lugar de un pty.
+
+    ``close`` sólo cierra la conexión: el Evolver sigue vivo en el supervisor.
+    """
+
+    def __init__(self, sock, timeout=30, maxread=MAXREAD,
+                 searchwindowsize=SEARCH_WINDOW, logfile=None):
+        self.pid = None
+        self.exitstatus = None
+        self._sock = sock
+        self._attach(sock.fileno(), timeout, maxread, searchwindowsize, logfile)
+
+    def sendintr(self):
+        """Envía ``^C`` al supervisor, que lo atiende fuera de banda.
+
+        Se descarta la entrada aún no enviada; el ``^C`` se escribe aunque haya
+        que esperar a que el socket admita datos.
+        """
+        self._pending.clear()
+        try:
+            self._sock.settimeout(self.timeout)
+            self._sock.sendall(b'\x03')
+        except socket.timeout as exc:
+            raise EvolverTimeout("el supervisor no acepta la interrupción") from exc
+        except OSError as exc:
+            raise _write_error(exc) from exc
+        finally:
+            self._sock.setblocking(False)
+
+    def isalive(self):
+        return self.fd >= 0
+
+    def close(self):
+        if self.fd < 0:
+            return
+        self._sel.close()
+        self._sock.close()
+        self.fd = -1
+
+
+def _check_peer(sock, path):
+    """Lanza ``PermissionError`` si quien escucha en ``path`` no es del mismo
+    usuario."""
+    uid = _peer_uid(sock)
+    if uid is None:
+        uid = os.stat(path).st_uid
+    if uid != os.getuid():
+        sock.close()
+        raise PermissionError(f"{path} pertenece a otro usuario (uid {uid})")
+
+
+def _try_connect(path):
+    """Conecta con ``path``; ``None`` si no hay nadie escuchando."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    _check_peer(sock, path)
+    return sock
+
+
+async def _try_connect_async(path):
+    """Como ``_try_connect``, esperando en el bucle de eventos."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.get_running_loop().sock_connect(sock, path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    _check_peer(sock, path)
+    return sock
+
+
+async def _launch(path, cmd, datafile, cwd, timeout):
+    """Lanza el supervisor (Evolver en ``cwd``) y espera a que avise de que
+    Evolver pasó el handshake y ya escucha en ``path``.
+
+    Si Evolver no arranca, el supervisor envía el motivo por el pipe en lugar
+    del aviso y se lanza ``EvolverEOF`` con él.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'evolver_kernel.supervisor', path, cmd, datafile,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    try:
+        # ``_READY`` por el pipe si todo fue bien; si no, el motivo hasta EOF.
+        # El handshake son dos esperas de hasta ``timeout`` cada una.
+        reply = await asyncio.wait_for(proc.stdout.read(), 2 * timeout)
+    except asyncio.TimeoutError:
+        raise EvolverTimeout(f"el supervisor no abrió {path}") from None
+    finally:
+        await proc.wait()  # sólo el intermedio del doble fork: sale enseguida
+    if reply != _READY:
+        reason = reply.decode('utf-8', 'replace').strip()
+        raise EvolverEOF(reason or f"el supervisor terminó sin abrir {path}")
+
+
+async def connect(cmd, datafile, timeout=30, **kwargs):
+    """Conecta con el supervisor de ``cmd`` + ``datafile`` para el directorio de
+    trabajo actual; lo lanza si no existe.
+
+    Devuelve un ``SupervisedEvolver``; ``kwargs`` se le pasan tal cual.
+    """
+    cwd = os.getcwd()
+    path = socket_path(cmd, datafile, cwd)
+    sock = await _try_connect_async(path)
+    if sock is None:
+        await _launch(path, cmd, datafile, cwd, timeout)
+        sock = await _try_connect_async(path)
+        if sock is None:
+            raise EvolverEOF(f"el supervisor no abrió {path}")
+    try:
+        reply = await asyncio.wait_for(
+            asyncio.get_running_loop().sock_recv(sock, 1), timeout)
+    except BaseException:
+        sock.close()
+        raise
+    if reply != _ACCEPTED:
+        sock.close()
+        if reply == _BUSY:
+            raise SupervisorBusy("otro kernel está usando este Evolver persistente")
+        raise EvolverEOF(f"el supervisor de {path} cerró la conexión")
+    return SupervisedEvolver(sock, timeout=timeout, **kwargs)
+
+
+# ---------------------------------------------------------------------------
+# Lado supervisor
+# ---------------------------------------------------------------------------
+def _listen(path):
+    """Abre el socket de escucha; ``None`` si ya hay otro supervisor vivo."""
+    if os.path.exists(path):
+        probe = _try_connect(path)
+        if probe is not None:
+            probe.close()
+            return None
+        os.unlink(path)  # socket huérfano de un supervisor muerto
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # El socket nace ya con 0600: sin ventana entre ``bind`` y ``chmod``
+    umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(1)
+    return listener
+
+
+def _ready(error=None):
+    """Avisa por stdout (el pipe de ``_launch``) de que ya se puede conectar, o
+    envía ``error``, y lo suelta: el kernel no espera a nada más."""
+    try:
+        os.write(1, _READY if error is None else error.encode('utf-8', 'replace'))
+    except OSError:
+        pass
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+
+def serve(path, cmd, datafile):
+    """Lanza Evolver, responde al prompt de datafile y reenvía bytes entre el
+    pty y el kernel conectado hasta que Evolver muere o vence ``IDLE_TIMEOUT``."""
+    listener = _listen(path)
+    if listener is None:
+        _ready()  # otro supervisor ya escucha en ``path``
+        return
+    # Terminar con SIGTERM/SIGHUP pasa por el ``finally``: se borra el socket
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, lambda *_: sys.exit(0))
+    proc = None
+    try:
+        proc = EvolverProc(cmd)
+        error = _handshake(proc, datafile)
+        _ready(error)
+        if error is None:
+            _relay(listener, proc)
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.unlink(path)
+        if proc is not None:
+            proc.close()
+
+
+def _handshake(proc, datafile):
+    """Responde al prompt de datafile y espera al principal.
+
+    Devuelve el motivo si Evolver termina antes (``None`` si sigue vivo). Un
+    prompt que no llega a tiempo no es un error: el kernel se resincroniza con
+    un marcador al conectar.
+    """
+    try:
+        try:
+            proc.expect(_PROMPT_RES['file'])
+        except EvolverTimeout:
+            pass
+        proc.sendline(datafile)
+        try:
+            proc.expect(_PROMPT_RES['main'])
+        except EvolverTimeout:
+            pass
+    except EvolverEOF as exc:
+        # Lo que Evolver escribió antes de terminar (p. ej. un ``exec`` fallido)
+        detail = proc.before.strip()
+        return f"{exc}: {detail}" if detail else str(exc)
+    return None
+
+
+def _relay(listener, proc):
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ, 'accept')
+    sel.register(proc.fd, selectors.EVENT_READ, 'evolver')
+    client = None
+    to_evolver = bytearray()
+    while True:
+        events = sel.select(None if client is not None else IDLE_TIMEOUT)
+        if not events and client is None:
+            return
+        for key, mask in events:
+            if key.data == 'accept':
+                conn, _addr = listener.accept()
+                if _peer_uid(conn) not in (None, os.getuid()):
+                    conn.close()
+                    continue
+                # Un segundo kernel se rechaza: desplazar al primero le haría
+                # perder su siguiente celda contra una conexión ya cerrada
+                try:
+                    conn.sendall(_ACCEPTED if client is None else _BUSY)
+                except OSError:
+                    conn.close()
+                    continue
+                if client is not None:
+                    conn.close()
+                    continue
+                client = conn
+                to_evolver.clear()
+                sel.register(client, selectors.EVENT_READ, 'client')
+            elif key.data == 'evolver':
+                if mask & selectors.EVENT_WRITE and to_evolver:
+                    try:
+                        del to_evolver[:os.write(proc.fd, to_evolver)]
+                    except BlockingIOError:
+                        pass
+                if mask & selectors.EVENT_READ:
+                    try:
+                        data = os.read(proc.fd, MAXREAD)
+                    except BlockingIOError:
+                        continue
+                    except OSError:  # EIO: Evolver cerró el pty
+                        data = b''
+                    if not data:
+                        return
+                    if client is not None:
+                        try:
+                            client.sendall(data)
+                        except OSError:
+                            sel.unregister(client)
+                            client.close()
+                            client = None
+            elif key.fileobj is client:
+                try:
+                    data = client.recv(MAXREAD)
+                except OSError:
+                    data = b''
+                if not data:
+                    sel.unregister(client)
+                    client.close()
+                    client = None
+                    continue
+                cut = data.rfind(b'\x03') + 1
+                if cut:
+                    # ^C fuera de banda: lo pendiente para Evolver (aquí y en la
+                    # cola del pty) se descarta antes de interrumpirlo
+                    to_evolver.clear()
+                    data = data[cut:]
+                    try:
+                        proc.sendintr()
+                    except EvolverEOF:
+                        return
+                to_evolver += data
+        wanted = selectors.EVENT_READ | (selectors.EVENT_WRITE if to_evolver else 0)
+        sel.modify(proc.fd, wanted, 'evolver')
+
+
+def main(argv=None):
+    path, cmd, datafile = sys.argv[1:] if argv is None else argv
+    # Doble fork: el proceso lanzado por el kernel termina enseguida y el
+    # supervisor queda adoptado por init (sin zombis en el kernel)
+    if os.fork() > 0:
+        return
+    serve(path, cmd, datafile)
+
+
+if __name__ == '__main__':
+    main()
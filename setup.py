@@ -4,7 +4,7 @@ setup(
     name='evolver_kernel',
     version='0.1',
     packages=['evolver_kernel'],
-    install_requires=['metakernel'],
+    install_requires=['metakernel', 'ipykernel>=6'],
     entry_points={
         'console_scripts': [
             'install_evolver_kernel = evolver_kernel.install:main'